@@ -1,29 +1,26 @@
-from collections import defaultdict
+import numpy as np
 import glob
 
-with open("dat/WORLD.MAP", "rb") as fh:
-    world = fh.read(256*256)
+world = np.memmap("dat/WORLD.MAP", dtype=np.uint8, mode='r', shape=(256*256,))
 
-count = defaultdict(int)
-for block in world:
-    count[block] += 1
+count = np.bincount(world, minlength=256)
 
 print("WORLD:")
 
-for k, v in sorted(count.items()):
-    print("%02X %s" % (k, v))
+for k, v in enumerate(count):
+    if v:
+        print("%02X %s" % (k, v))
 
-count = defaultdict(int)
+count = np.zeros(256, dtype=np.int64)
 
 for filename in glob.glob("dat/*.ULT"):
-    with open(filename, "rb") as fh:
-        world = fh.read(32*32)
-        for block in world:
-            count[block] += 1
+    world = np.memmap(filename, dtype=np.uint8, mode='r', shape=(32*32,))
+    count += np.bincount(world, minlength=256)
 
 print("\nTOWNS:")
 
-for k, v in sorted(count.items()):
-    print("%02X %s" % (k, v))
+for k, v in enumerate(count):
+    if v:
+        print("%02X %s" % (k, v))
 
 
@@ -1,49 +1,32 @@
 from PIL import Image
 import numpy as np
+from scipy.ndimage import median_filter
 import cProfile
 
-with open("dat/WORLD.MAP", "rb") as fh:
-    world = fh.read(65536)
+world = np.memmap("dat/WORLD.MAP", dtype=np.uint8, mode='r', shape=(65536,))
 
-def tile(x, y):
-    if 0 <= x <= 255 and 0 <= y <= 255:
-        b = world[(y//32)*8192+(x//32)*1024+(y%32)*32+(x%32)]
-        if b == 0x17: return 3
-        if b == 9: return 8
-        if b < 9: return b
-        return 4
-    return 0
+# The map is stored as 8x8 chunks of 32x32 tiles, so untangle it
+# into a plain 256x256 grid indexed by [y, x].
+
+world = world.reshape(8, 8, 32, 32).transpose(0, 2, 1, 3).reshape(256, 256)
+
+# Lookup table mapping Ultima tile bytes to terrain heights:
+# bridges are swamp, dungeons are mountains, anything else is grass.
+
+LUT = np.full(256, 4, dtype=np.uint8)
+LUT[:9] = np.arange(9)
+LUT[9] = 8
+LUT[0x17] = 3
 
 scale = 12
 width = 256 * scale
 
-w = bytearray()
-for y in range(256):
-    for _ in range(scale):
-        for x in range(256):
-            t = tile(x, y)
-            w.extend([t] * scale)
+w = np.repeat(np.repeat(LUT[world], scale, axis=0), scale, axis=1)
 
 span = scale // 2 + 1
 
 def smooth(w):
-    ww = w.copy()
-    for x in range(span, width-span-1):
-        for y in range(span, width-span-1):
-            tt = [
-                t
-                for yy in range(y-span, y+span+1)
-                for t in w[yy*width+x-span:yy*width+x+span+1]
-            ]
-            if all(t == tt[0] for t in tt[1:]):
-                continue
-            tt.sort()
-            ww[y*width+x] = tt[len(tt)//2]
-    
-    return [
-        ww[y*width:(y+1)*width]
-        for y in range(width)
-    ]
+    return median_filter(w, size=2*span+1, mode='nearest')
 
 #cProfile.run("smooth(w)")
 
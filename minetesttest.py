@@ -1,6 +1,9 @@
 import sqlite3
-import zstd
+import struct
+import zstandard
 import random
+import numpy as np
+from functools import lru_cache
 
 # https://wiki.minetest.org/Games/Minetest_Game/Nodes
 
@@ -18,17 +21,25 @@ block_map = {
 
 valid_blocks = set(block_map.values())
 
+# pack each block mapping entry just once rather than for every block.
+
+block_map_entries = {
+    v: struct.pack('>HH', v, len(k)) + bytes(k, 'ascii')
+    for k, v in block_map.items()
+}
+
 print(valid_blocks)
 
-def u16(n):
-    yield n >> 8 & 0xFF
-    yield n & 0xFF
+# param1 and param2 are always all zeros, and there are never any node
+# timers, so these parts of every block are the same bytes every time.
+
+PARAM1_PARAM2 = bytes(4096 * 2)
 
-def u32(n):
-    yield n >> 24 & 0xFF
-    yield n >> 16 & 0xFF
-    yield n >> 8 & 0xFF
-    yield n & 0xFF
+TRAILER = struct.pack('>IBH',
+    0,
+    10,
+    0,  # no timers
+)
 
 # see https://github.com/luanti-org/luanti/blob/master/doc/world_format.md#mapsqlite-1
 # for database format details
@@ -38,72 +49,100 @@ def block_to_data(block):
     assert type(block) is bytes
     assert len(block) == 4096
 
+    data = bytearray()
+
     # headers
 
-    yield 14 # flags: generated, lighting expired, day_night_differs, NOT is_underground
-    yield from u16(0) # lighting needs recomputing in all directions
-    yield from u32(0xffffffff) # timestamp
+    data += struct.pack('>BHI',
+        14,         # flags: generated, lighting expired, day_night_differs, NOT is_underground
+        0,          # lighting needs recomputing in all directions
+        0xffffffff, # timestamp
+    )
 
     # block mapping: only bother including blocks present in
     # this sector.
 
-    present_blocks = set(block)
-    present_block_map = [ (k, v) for k, v in block_map.items() if v in present_blocks ]
-
-    yield 0    # mapping version
-    yield from u16(len(present_block_map)) # length of block map
-    for k, v in present_block_map:
-        yield from u16(v)
-        yield from u16(len(k))
-        yield from bytes(k, 'ascii')
-    yield 2 # content_width
-    yield 2 # params_width
-
-    for b in block:
-        yield from u16(b) # param0
+    present_blocks = np.flatnonzero(np.bincount(np.frombuffer(block, dtype=np.uint8), minlength=256)).tolist()
 
-    for b in block:
-        yield 0           # param1
+    data += struct.pack('>BH',
+        0,                   # mapping version
+        len(present_blocks), # length of block map
+    )
+    data += b''.join(block_map_entries[v] for v in present_blocks)
+    data += struct.pack('>BB',
+        2, # content_width
+        2, # params_width
+    )
 
-    for b in block:
-        yield 0           # param2
+    data += np.frombuffer(block, dtype=np.uint8).astype('>u2').tobytes() # param0
+    data += PARAM1_PARAM2
+    data += TRAILER
 
-    yield from u32(0)
+    return bytes(data)
 
-    yield 10
-    yield from u16(0)  # no timers
 
+compressor = zstandard.ZstdCompressor(level=3)
 
 def block_to_binary(block):
-
-    yield 29
-    yield from zstd.compress(bytes(block_to_data(block)))
+    return bytes([29]) + compressor.compress(block_to_data(block))
 
 
 db = sqlite3.connect('/home/nick/.minetest/worlds/x/map.sqlite')
-
-def write_block(x, y, z, block):
+db.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=OFF;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-262144;
+    PRAGMA locking_mode=EXCLUSIVE;
+
+    -- same schema Luanti creates, except that an INTEGER PRIMARY KEY is
+    -- the rowid itself rather than a separate index to keep up to date.
+    CREATE TABLE IF NOT EXISTS blocks (pos INTEGER PRIMARY KEY, data BLOB);
+""")
+
+# SQLite is much faster at bulk inserts if they're all done in a single
+# transaction with a single prepared statement, so feed every row through
+# one executemany and only commit once everything is written.
+
+# Blocks which are one material all the way through always encode the
+# same way, and that's all of them here, so only encode each one once.
+
+@lru_cache(maxsize=256)
+def uniform_block_to_binary(n):
+    return block_to_binary(bytes([n]) * 4096)
+
+def block_row(x, y, z, block):
     pos = x * 4096 * 4096 + y + z * 4096
-    data = bytes(block_to_binary(block))
-    db.execute("insert or replace into blocks (pos, data) values (?, ?)", (pos, data))
+    if block == block[:1] * 4096:
+        data = uniform_block_to_binary(block[0])
+    else:
+        data = block_to_binary(block)
+    return pos, data
 
-with open('WORLD.MAP', 'rb') as fh:
-    world = fh.read(65536)
+world = np.memmap('WORLD.MAP', dtype=np.uint8, mode='r', shape=(65536,))
 
 #print(world)
 
-for x1 in range(0,8):
-    for y1 in range(0,8):
-        for x2 in range(0,32):
-            for y2 in range(0,32):
-                x = x1*32+x2
-                y = y1*32+y2
-                n = world[y1*8192+x1*1024+y2*32+x2]
-                print("%d %d %d %d => %d %d => %d" % (x1, y1, x2, y2, x, y, n))
-                if n in valid_blocks:
-                    write_block(x, y, 0, bytes([n]) * 4096)
-        db.commit()
+# The map is stored as 8x8 chunks of 32x32 tiles, so untangle it
+# into a plain 256x256 grid indexed by [y, x].
+
+world = world.reshape(8, 8, 32, 32).transpose(0, 2, 1, 3).reshape(256, 256)
+
+# x is the slowest-varying part of pos here, so go through the map
+# column by column to insert the blocks in pos order.
+
+def block_rows():
+    for x in range(0,256):
+        for y in range(0,256):
+            n = world[y, x]
+            if n in valid_blocks:
+                yield block_row(x, y, 0, bytes([n]) * 4096)
+
+print("Writing blocks ...")
 
+db.executemany("insert or replace into blocks (pos, data) values (?, ?)", block_rows())
+db.commit()
+print("Done.")
 db.close()
 
 
@@ -1,12 +1,11 @@
 import sqlite3
-import zstd
+import struct
+import multiprocessing
+import zstandard
 import random
 from collections import defaultdict
-import random
-from statistics import median
-from functools import lru_cache
-
-median = lru_cache(median)
+import numpy as np
+from scipy.ndimage import median_filter
 
 # The read format (Ultima IV) and write format (minetest) are so different that
 # the easiest way to convert between them is an intermediate format. We could
@@ -27,17 +26,34 @@ median = lru_cache(median)
 # "The locations of each block in the chunk is given by ((z%16)*16*16 + (y%16)*16 + (x%16))"
 # https://github.com/luanti-org/luanti/blob/master/doc/world_format.md#node-data
 #
-# The overhead of storing 1,000,000 or so chunks in separate buffers isn't much
-# so let's do that. Unused chunks default to all zeros, which we can map to "air".
+# The whole world is only 256*SCALE blocks across and a couple of chunks
+# high though, so rather than keeping chunks in separate buffers it's
+# simpler and faster to keep them all in one big numpy array, indexed
+# by chunk [z, y, x] and then by position within the chunk, also [z, y, x].
+# That way each chunk is already a contiguous block of bytes in the
+# right order to write out.
+# Unused space defaults to all zeros, which we can map to "air".
 
 CHUNK = 16
-CHUNK3 = CHUNK * CHUNK * CHUNK
 
-World = defaultdict(lambda: bytearray(CHUNK3))
+SCALE = 12
+
+WIDTH = 256 * SCALE
+
+# Z runs from 1 to WIDTH (see below) so leave an extra chunk for it,
+# and towns can stack up above the first chunk of height.
 
-def set_block(x, y, z, b):
-    chunk = World[(x//CHUNK,y//CHUNK,z//CHUNK)]
-    chunk[(z%CHUNK)*CHUNK*CHUNK + (y%CHUNK)*CHUNK + (x%CHUNK)] = b
+HEIGHT = 2 * CHUNK
+
+World = np.zeros((
+    (WIDTH + CHUNK) // CHUNK, HEIGHT // CHUNK, (WIDTH + CHUNK) // CHUNK,
+    CHUNK, CHUNK, CHUNK,
+), dtype=np.uint8)
+
+# Also keep track of which chunks have had anything written to them,
+# so the rest can be skipped without having to look inside them.
+
+touched_chunks = np.zeros(World.shape[:3], dtype=bool)
 
 # Minetest uses "itemstrings" to describe its various blocks, we don't 
 # want to store these so we keep a table translating them to byte values.
@@ -47,8 +63,8 @@ def set_block(x, y, z, b):
 # for full representation of villages etc we might need
 # to make some custom "letter blocks", etc.
 
-# Add new block types as they get seen.  The world chunk bytearrays 
-# are initialized to all zeros, so we start with 0 mapped to "air".
+# Add new block types as they get seen.  The world array is
+# initialized to all zeros, so we start with 0 mapped to "air".
 
 block_map = {
         "air": 0,
@@ -61,45 +77,26 @@ def get_block_byte(itemstring):
 
 print("Loading World")
 
-with open("dat/WORLD.MAP", "rb") as fh:
-    ultima_world = fh.read(256*256)
+ultima_world = np.memmap("dat/WORLD.MAP", dtype=np.uint8, mode='r', shape=(256*256,))
 
-SCALE = 12
+# The map is stored as 8x8 chunks of 32x32 tiles, so untangle it
+# into a plain 256x256 grid indexed by [y, x].
 
-WIDTH = 256 * SCALE
+ultima_world = ultima_world.reshape(8, 8, 32, 32).transpose(0, 2, 1, 3).reshape(256, 256)
 
 # XXX doing this in two stages is a bit silly, 
 # could just do it in a single pass.
 
 print(f"Scaling by {SCALE}")
 
-scaled_world = bytearray(256*SCALE*256*SCALE)
-
-for x in range(WIDTH):
-    for y in range(WIDTH):
-        xx = x // SCALE
-        yy = y // SCALE
-        scaled_world[y * WIDTH + x] = ultima_world[(yy//32)*8192+(xx//32)*1024+(yy%32)*32+(xx%32)]
+scaled_world = np.repeat(np.repeat(ultima_world, SCALE, axis=0), SCALE, axis=1)
 
 SPAN = SCALE // 2 + 1
 #SPAN = 2
 
 print(f"Smoothing by {SPAN}")
 
-smoothed_world = scaled_world.copy()
-
-progress = 0
-for y in range(SPAN, WIDTH-SPAN-1):
-    percent = 100 * y // WIDTH
-    if percent > progress + 4:
-        print("... %d%%" % percent)
-        progress = percent
-    for x in range(SPAN, WIDTH-SPAN-1):
-        smoothed_world[y*WIDTH+x] = median(tuple(
-            scaled_world[yy*WIDTH+xx]
-            for yy in range(y-SPAN, y+SPAN+1)
-            for xx in range(x-SPAN, x+SPAN+1)
-        ))
+smoothed_world = median_filter(scaled_world, size=2*SPAN+1, mode='nearest')
 
 # This maps the Ultima IV tile types to little stacks of Minetest
 # blocks.
@@ -137,6 +134,46 @@ blocks_for_tile = {
 
 default_blocks_for_tile = lambda: [ 'default:goldblock' ] * 4
 
+# Most tile types always turn into the same stack of blocks, only
+# these ones roll the dice every time.  Rather than rolling them for
+# every position, roll up a bunch of variants of each one in advance
+# and pick from those at random.
+
+random_tiles = { 5, 6, 7, 8, 0x4C }
+
+VARIANTS = 64
+
+rng = np.random.default_rng()
+
+stacks_for_tile = {
+    tile: [
+        [ get_block_byte(block) for block in block_generator() ]
+        for _ in range(VARIANTS if tile in random_tiles else 1)
+    ]
+    for tile, block_generator in blocks_for_tile.items()
+}
+
+default_blocks = [ get_block_byte(block) for block in default_blocks_for_tile() ]
+
+# Pack the stacks into a table indexed by tile type and variant, padded
+# out with air, plus the height of each stack.  Non-random tiles have
+# the same stack for every variant, and unknown tiles have a height of
+# zero.
+
+MAX_STACK = max(len(stack) for stacks in stacks_for_tile.values() for stack in stacks)
+
+stack_table = np.zeros((256, VARIANTS, MAX_STACK), dtype=np.uint8)
+stack_heights = np.zeros((256, VARIANTS), dtype=np.int32)
+
+for tile, stacks in stacks_for_tile.items():
+    for variant in range(VARIANTS):
+        stack = stacks[variant % len(stacks)]
+        stack_table[tile, variant, :len(stack)] = stack
+        stack_heights[tile, variant] = len(stack)
+
+known_tiles = np.zeros(256, dtype=bool)
+known_tiles[list(blocks_for_tile)] = True
+
 # The idea here is to integrate towns into the map so
 # there's just a single map.  Towns have a 32x32 map size
 # so the obvious thing would be to make each "world" 
@@ -154,47 +191,61 @@ default_blocks_for_tile = lambda: [ 'default:goldblock' ] * 4
 # Y axis runs North -> South, which is the opposite direction
 # to the minetest Z axis.
 
-print("Generating blocks")
-
 unknown_tiles = defaultdict(int)
 
-progress = 0
-
-for y in range(WIDTH):
-    percent = 100 * y // WIDTH
-    if percent > progress + 4:
-        print("... %d%%" % percent)
-        progress = percent
-    
-    for x in range(WIDTH):
-        tile = smoothed_world[y*WIDTH+x]
-        block_generator = blocks_for_tile.get(tile)
-        if not block_generator:
-            unknown_tiles[tile] += 1
-            block_generator = default_blocks_for_tile
+# Rather than visiting every position one at a time, pick a variant
+# for every position and look up all their stacks in the table at once,
+# and then write out each layer of the stacks in one go.
+#
+# tiles is a [row, col] array of tile types. Columns run East along X
+# from x0, rows run South so they go backwards along Z from z0, and
+# the stacks start at height y0.  Unknown tiles get default blocks, or
+# are left empty if there aren't any.
+
+def place_tiles(tiles, x0, y0, z0, default=None):
+    tile_counts = np.bincount(tiles.ravel(), minlength=256)
+    for tile in np.nonzero(tile_counts * ~known_tiles)[0].tolist():
+        unknown_tiles[tile] += tile_counts[tile]
+
+    table, heights = stack_table, stack_heights
+    if default is not None:
+        table, heights = table.copy(), heights.copy()
+        table[~known_tiles, :, :len(default)] = default
+        heights[~known_tiles] = len(default)
+
+    variants = rng.integers(VARIANTS, size=tiles.shape, dtype=np.uint8)
+
+    # Work out which chunk each column is in just once rather than for
+    # every layer, and sort the columns tallest first so that each layer
+    # is just the first however many of them.
+
+    rows, cols = np.nonzero(heights[tiles, variants])
+    column_tiles = tiles[rows, cols]
+    column_variants = variants[rows, cols]
+    order = np.argsort(heights[column_tiles, column_variants], kind='stable')[::-1]
+    column_tiles = column_tiles[order]
+    column_variants = column_variants[order]
+    column_heights = heights[column_tiles, column_variants]
+    xc, xl = np.divmod(x0 + cols[order], CHUNK)
+    zc, zl = np.divmod(z0 - rows[order], CHUNK)
+
+    for oy in range(table.shape[2]):
+        n = np.count_nonzero(column_heights > oy)
+        yc, yl = divmod(y0 + oy, CHUNK)
+        World[zc[:n], yc, xc[:n], zl[:n], yl, xl[:n]] = table[column_tiles[:n], column_variants[:n], oy]
+        touched_chunks[zc[:n], yc, xc[:n]] = True
 
-        for (z, block) in enumerate(block_generator()):
-            bb = get_block_byte(block)
-            set_block(x, z, WIDTH-y, bb)
+print("Generating blocks")
 
+place_tiles(smoothed_world, 0, 0, WIDTH, default_blocks)
 
 # towns are a single 32x32 chunk of tiles
 
 def read_town(map_name, x, y, z=4):
     xo = x * SCALE + SCALE//2 - 16
     yo = (255-y) * SCALE + SCALE//2 + 16
-    with open(f"dat/{map_name}.ULT", "rb") as fh:
-        ultima_town = fh.read(32*32)
-        for tx in range(0,32):
-            for ty in range(0,32):
-                tile = ultima_town[ty*32+tx]
-                block_generator = blocks_for_tile.get(tile)
-                if not block_generator:
-                    unknown_tiles[tile] += 1
-                    continue
-                for (oz, block) in enumerate(block_generator()):
-                    bb = get_block_byte(block)
-                    set_block(xo + tx, z + oz, yo - ty, bb)
+    ultima_town = np.memmap(f"dat/{map_name}.ULT", dtype=np.uint8, mode='r', shape=(32, 32))
+    place_tiles(ultima_town, xo, z, yo)
     print("... %s at (%d, %d)" % (map_name, x * SCALE, (255-y) * SCALE))
 
 # locations based on ...
@@ -256,82 +307,143 @@ for k, v in sorted(unknown_tiles.items()):
 # ============================================================
 # LUANTI / MINETEST FILE FORMAT STUFF
 
-def u16(n):
-    yield n >> 8 & 0xFF
-    yield n & 0xFF
-
-def u32(n):
-    yield n >> 24 & 0xFF
-    yield n >> 16 & 0xFF
-    yield n >> 8 & 0xFF
-    yield n & 0xFF
-
 # see https://github.com/luanti-org/luanti/blob/master/doc/world_format.md#mapsqlite-1
 # for database format details
 
-def block_to_data(block):
-    # block is a binary array of node IDs in ZYX order.
-    assert len(block) == 4096
-
-    # headers
+# block_map is complete by now, so pack each block mapping entry
+# just once rather than for every block.
 
-    yield 14 # flags: generated, lighting expired, day_night_differs, NOT is_underground
-    yield from u16(0) # lighting needs recomputing in all directions
-    yield from u32(0xffffffff) # timestamp
+block_map_entries = {
+    v: struct.pack(">HH", v, len(k)) + bytes(k, 'ascii')
+    for k, v in block_map.items()
+}
 
-    # block mapping: only bother including blocks present in
-    # this sector.
+# Every block is encoded into the same scratch buffer, sized for the
+# biggest possible block mapping.  Pool workers are forked so each gets
+# its own copy.
 
-    present_blocks = set(block)
-    present_block_map = [ (k, v) for k, v in block_map.items() if v in present_blocks ]
+scratch = bytearray(10 + sum(map(len, block_map_entries.values())) + 2 + 4096 * 4 + 7)
 
-    yield 0    # mapping version
-    yield from u16(len(present_block_map)) # length of block map
-    for k, v in present_block_map:
-        yield from u16(v)
-        yield from u16(len(k))
-        yield from bytes(k, 'ascii')
-    yield 2 # content_width (always 2)
-    yield 2 # params_width  (always 2)
+PARAM1_PARAM2 = bytes(4096 * 2)
 
-    for b in block:
-        yield from u16(b) # param0
+def block_to_data(block):
+    # block is a binary array of node IDs in ZYX order, either bytes
+    # or a flat view straight into World.  The result is a view into
+    # scratch so it's only good until the next call.
+    assert len(block) == 4096
+    nodes = np.frombuffer(block, dtype=np.uint8)
 
-    for b in block:
-        yield 0           # param1
+    # block mapping: only bother including blocks present in
+    # this sector.
 
-    for b in block:
-        yield 0           # param2
+    present_blocks = np.flatnonzero(np.bincount(nodes, minlength=256)).tolist()
+    mapping = b''.join(block_map_entries[v] for v in present_blocks)
 
-    yield from u32(0)
+    data = scratch
 
-    yield 10             # timer record size (always 10)
-    yield from u16(0)  # no timers
+    # headers
 
+    struct.pack_into(">BHI", data, 0,
+        14,         # flags: generated, lighting expired, day_night_differs, NOT is_underground
+        0,          # lighting needs recomputing in all directions
+        0xffffffff, # timestamp
+    )
+
+    struct.pack_into(">BH", data, 7,
+        0,                   # mapping version
+        len(present_blocks), # length of block map
+    )
+    offset = 10
+    data[offset:offset+len(mapping)] = mapping
+    offset += len(mapping)
+
+    struct.pack_into(">BB", data, offset,
+        2, # content_width (always 2)
+        2, # params_width  (always 2)
+    )
+    offset += 2
+
+    # param0 is just each node ID as a big-endian u16, converted
+    # straight into place.  param1 and param2 are all zeros, but the
+    # last block may have left something else there.
+    np.frombuffer(data, dtype='>u2', count=4096, offset=offset)[:] = nodes
+    offset += 4096 * 2
+    data[offset:offset+4096*2] = PARAM1_PARAM2
+    offset += 4096 * 2
+
+    struct.pack_into(">IBH", data, offset,
+        0,
+        10, # timer record size (always 10)
+        0,  # no timers
+    )
+    offset += 7
+
+    return memoryview(data)[:offset]
+
+
+# Reuse one compression context for every block rather than setting
+# up a new one each time.
+
+compressor = zstandard.ZstdCompressor(level=3)
 
 def block_to_binary(block):
-    yield 29              # chunk version number
-    yield from zstd.compress(bytes(block_to_data(block)))
+    # chunk version number
+    return bytes([29]) + compressor.compress(block_to_data(block))
 
 db = sqlite3.connect('/home/nick/.minetest/worlds/x/map.sqlite')
-
-def write_block(x, y, z, block):
+db.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=OFF;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-262144;
+    PRAGMA locking_mode=EXCLUSIVE;
+
+    -- same schema Luanti creates, except that an INTEGER PRIMARY KEY is
+    -- the rowid itself rather than a separate index to keep up to date.
+    CREATE TABLE IF NOT EXISTS blocks (pos INTEGER PRIMARY KEY, data BLOB);
+""")
+
+# SQLite is much faster at bulk inserts if they're all done in a single
+# transaction with a single prepared statement, so feed every row through
+# one executemany and only commit once everything is written.
+
+def encode_block(chunk_pos):
+    z, y, x = chunk_pos
+    chunk = World[z, y, x]
+    # a chunk which only ever had air written to it needn't be written
+    if not chunk.any():
+        return None
     pos = z * 4096 * 4096 + y * 4096 + x
-    data = bytes(block_to_binary(block))
-    db.execute("insert or replace into blocks (pos, data) values (?, ?)", (pos, data))
-
-print("Writing %d blocks ..." % len(World))
-progress = 0
-for n, ((x, y, z), bb) in enumerate(World.items()):
-    percent = 100 * n // len(World)
-    write_block(x, y, z, bb)
-    if percent > progress + 4:
-        db.commit()
-        print("... %d%%" % percent)
-        progress = percent
+    # chunks are contiguous in World, so there's no need to copy them out
+    return pos, block_to_binary(chunk.ravel())
+
+# Chunks which were never touched are all air and don't need writing.
+
+chunk_positions = np.argwhere(touched_chunks).tolist()
+
+# Encoding and compressing blocks is the slow part and every block is
+# independent, so farm it out to all the CPUs and just do the inserts
+# here.  argwhere lists chunks in z, y, x order, which is also pos order,
+# so keeping the results in order means every insert is an append to the
+# end of the table.  Workers are forked so they inherit World and the
+# block map entries instead of re-running this whole script.
+
+def block_rows(pool):
+    progress = 0
+    for n, row in enumerate(pool.imap(encode_block, chunk_positions, chunksize=64)):
+        percent = 100 * n // len(chunk_positions)
+        if row:
+            yield row
+        if percent > progress + 4:
+            print("... %d%%" % percent)
+            progress = percent
+
+print("Writing %d blocks ..." % len(chunk_positions))
+with multiprocessing.get_context("fork").Pool() as pool:
+    db.executemany("insert or replace into blocks (pos, data) values (?, ?)", block_rows(pool))
+db.commit()
 print("Done.")
 
-db.commit()
 db.close()
 
 